@@ -1,150 +1,320 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from time import time
 
+# Flat indices (row * 9 + col) of the boxes in each row, column and quadrant
+ROW_IDXS = tuple(
+    tuple(row * 9 + col for col in range(9))
+    for row in range(9)
+)
+COL_IDXS = tuple(
+    tuple(row * 9 + col for row in range(9))
+    for col in range(9)
+)
+QUADRANT_IDXS = tuple(
+    tuple((r0 + r) * 9 + (c0 + c) for r in range(3) for c in range(3))
+    for r0 in range(0, 9, 3) for c0 in range(0, 9, 3)
+)
+
+# Flat indices of the 20 boxes that share a row, column
+# or quadrant with each box of the board
+PEERS = tuple(
+    tuple(sorted((
+        set(ROW_IDXS[row]) |
+        set(COL_IDXS[col]) |
+        set(QUADRANT_IDXS[row//3 * 3 + col//3])
+    ) - {row * 9 + col}))
+    for row in range(9) for col in range(9)
+)
+
+# Every row, column and quadrant, which must each contain all numbers once
+UNITS = ROW_IDXS + COL_IDXS + QUADRANT_IDXS
+
+# Indices in UNITS of the row, column and quadrant of each box
+BOX_UNITS = tuple(
+    (row, 9 + col, 18 + row//3 * 3 + col//3)
+    for row in range(9) for col in range(9)
+)
+
+# Masks of BOX_UNITS, where bit i is set if the box is in UNITS[i]
+BOX_UNIT_MASKS = tuple(
+    (1 << row_unit) | (1 << col_unit) | (1 << quadrant_unit)
+    for row_unit, col_unit, quadrant_unit in BOX_UNITS
+)
+
+# Translates the board digits to the characters shown, '.' for empty boxes
+BOARD_CHARS = bytes.maketrans(bytes(range(10)), b'.123456789')
+
+# Characters allowed in a puzzle string
+PUZZLE_CHARS = set('.0123456789')
+
+# Translates the characters of a puzzle string to board digits,
+# where both '.' and '0' are empty boxes
+PUZZLE_DIGITS = bytes.maketrans(b'.0123456789', bytes([0]) + bytes(range(10)))
+
+# Representation of the board, with a field for each box
+BOARD_TEMPLATE = '\n-------+-------+-------\n'.join(
+    ['\n'.join([' {} {} {} | {} {} {} | {} {} {}'] * 3)] * 3
+)
+
 class Sudoku:
+    __slots__ = (
+        'board', 'ROWS', 'COLS', 'options_board', 'n_choices',
+        'queue', 'nonempty_mask', 'solvable', 'trail', 'dirty_units'
+    )
+
     def __init__(
         self,
         board,
         options_board=None,
         queue=None
     ):
+        self.ROWS = 9
+        self.COLS = 9
+
+        # The board is stored as a flat bytearray indexed by row * 9 + col,
+        # where 0 is an empty box and 1-9 are the numbers placed
+        if not isinstance(board, bytearray):
+            board = bytearray(
+                0 if cell == '.' else int(cell)
+                for row in board for cell in row
+            )
         self.board = board
-        self.ROWS = len(board)
-        self.COLS = len(board[0])
+        self.solvable = True
 
         self.options_board = options_board or self.init_options_board()
+
+        # Number of choices of each box, kept in sync with the options board
+        self.n_choices = bytearray(
+            options.bit_count() for options in self.options_board
+        )
         self.queue = queue or self.init_queue()
-        self.solvable = True
+
+        # Bit i is set if there are boxes with i choices in the queue
+        self.nonempty_mask = 0
+        for i, boxes in enumerate(self.queue):
+            if boxes:
+                self.nonempty_mask |= 1 << i
+
+        # Stack of (idx, options) pairs with the options each box had
+        # before being changed, used to undo choices when backtracking
+        self.trail = []
+
+        # Bit i is set if the options of a box in UNITS[i] changed since
+        # the unit was last searched for hidden singles
+        self.dirty_units = (1 << len(UNITS)) - 1
+
+    @staticmethod
+    def idx(row: int, col: int) -> int:
+        '''
+        Returns the flat idx of the box at (row, col), used to index the
+        board, options board and queue masks
+        '''
+        return row * 9 + col
     
     def init_options_board(self):
         '''
         Computes all the possible numbers for each box in the board.
-        The options of each box are a one-hot encoded vector of size 9.
+        The options of each box are a 9-bit mask, where bit i is set
+        if the number i + 1 can still be placed in the box.
+        The boxes are stored in a flat list indexed by row * 9 + col.
+        The board is marked as unsolvable if a number is repeated in a row,
+        column or quadrant, or if an empty box has no options.
         '''
-        # Initialize the options board with all options enabled
-        options_board = [[[1]*9 for _ in range(9)] for _ in range(9)]
-
-        for row in range(9):
-            for col in range(9):
-                if self.board[row][col] == '.':
-                    continue
-
-                # Disable all options for the box
-                options_board[row][col] = [0] * 9
-
-                # Disable the choice from the row and column
-                choice = int(self.board[row][col]) - 1
-                for n in range(9):
-                    options_board[row][n][choice] = 0
-                    options_board[n][col][choice] = 0
-
-                r0 = row//3 * 3
-                c0 = col//3 * 3
-
-                # Disable the choice from the box's quadrant
-                for r in range(r0, r0 + 3):
-                    for c in range(c0, c0 + 3):
-                        options_board[r][c][choice] = 0
+        board = self.board
+
+        # Numbers already placed in each row, column and quadrant
+        used = [0] * 27
+        for idx, (row_unit, col_unit, quadrant_unit) in enumerate(BOX_UNITS):
+            if board[idx]:
+                choice_bit = 1 << (board[idx] - 1)
+                if (used[row_unit] | used[col_unit] | used[quadrant_unit]) & choice_bit:
+                    self.solvable = False
+
+                used[row_unit] |= choice_bit
+                used[col_unit] |= choice_bit
+                used[quadrant_unit] |= choice_bit
+
+        # Filled boxes have no options, and empty boxes can take any
+        # number not placed in their row, column or quadrant
+        options_board = [0] * 81
+        for idx, (row_unit, col_unit, quadrant_unit) in enumerate(BOX_UNITS):
+            if not board[idx]:
+                options_board[idx] = 0x1FF & ~(
+                    used[row_unit] | used[col_unit] | used[quadrant_unit]
+                )
+                if not options_board[idx]:
+                    self.solvable = False
 
         return options_board
     
     def init_queue(self):
         '''
         Initializes the queue with the boxes that have the least number of choices.
-        The queue contains the pairs (row, col) at the index of the number of choices.
+        The queue contains, at the index of the number of choices, an 81-bit mask
+        where bit idx is set if the box at the flat idx has that number of choices.
         '''
-        queue = [set() for i in range(10)]
+        queue = [0] * 10
 
-        for row in range(9):
-            for col in range(9):
-                n_choices = sum(self.options_board[row][col])
+        for idx in range(81):
+            n_choices = self.n_choices[idx]
 
-                # Add idx to the position in the queue with the number of choices
-                queue[n_choices].add((row, col))
+            # Add idx to the position in the queue with the number of choices
+            queue[n_choices] |= 1 << idx
 
         return queue
     
-    def get_next(self):
+    def get_next(self) -> tuple[int, int]:
         ''' 
-        Returns the next best box to fill (least number of choices)
-        Returns 0, (-1, -1) if there are no more boxes to fill
+        Returns the next best box idx to fill (least number of choices)
+        Returns 0, -1 if there are no more boxes to fill
+        The box stays in the queue until it is filled
+        '''
+        # Skips the filled boxes at index 0 of the queue
+        nonempty_mask = self.nonempty_mask & ~1
+        if not nonempty_mask:
+            return 0, -1
+
+        i = (nonempty_mask & -nonempty_mask).bit_length() - 1
+        return i, self.queue[i].bit_length() - 1
+
+    def get_hidden_single(self) -> tuple[int, int]:
+        '''
+        Returns a choice that can only be placed in one box of a row, column
+        or quadrant, along with that box idx (a hidden single)
+        Returns -1, -1 if there are no hidden singles
+        Only the units that changed since they were last searched are searched
         '''
-        for i in range(1, 10):
-            if self.queue[i]:
-                return i, self.queue[i].pop()
-        return 0, (-1, -1)
+        options_board = self.options_board
+        dirty_units = self.dirty_units
+
+        while dirty_units:
+            unit = UNITS[(dirty_units & -dirty_units).bit_length() - 1]
+            dirty_units &= dirty_units - 1
+
+            # Choices seen in at least one and in at least two boxes of the unit
+            once = twice = 0
+            for idx in unit:
+                options = options_board[idx]
+                twice |= once & options
+                once |= options
+
+            hidden = once & ~twice
+            if hidden:
+                choice = (hidden & -hidden).bit_length() - 1
+                for idx in unit:
+                    if options_board[idx] >> choice & 1:
+                        self.dirty_units = dirty_units
+                        return choice, idx
+
+        self.dirty_units = 0
+        return -1, -1
     
-    def get_choice(self, row, col):
+    def get_choice(self, idx: int):
         ''' 
-        Generator that yields the possible choices for the box at (row, col)
+        Generator that yields the possible choices for the box at idx
         It should not be called if the box is already filled
         '''
-        for choice in range(9):
-            if self.options_board[row][col][choice]:
-                yield choice
-    
-    def update_state(self, row, col, choice):
-        '''
-        Updates the queue and options board after a choice is made
-        '''
-        if self.options_board[row][col][choice]:
-            n_choices = sum(self.options_board[row][col])
-
-            # If you remove the last choice of an empty box,
-            # its impossible to fill, so the board is unsolvable
-            if n_choices == 1 and self.board[row][col] == '.':
-                self.solvable = False
-
-            # Since an option was removed, the number of 
-            # choices for the box decreases by one
-            self.queue[n_choices].discard((row, col))
-            self.queue[n_choices - 1].add((row, col))
-
-            # Disables the choice from the options board
-            self.options_board[row][col][choice] = 0
+        options = self.options_board[idx]
 
-    def fill_box(self, row, col, choice: int):
+        # Yields the index of the lowest set bit and clears it
+        while options:
+            yield (options & -options).bit_length() - 1
+            options &= options - 1
+    
+    def fill_box(self, idx: int, choice: int):
         '''
-        Fills the box at (row, col) with the choice, updates
+        Fills the box at idx with the choice, updates
         the queue and options board
         '''
+        options_board = self.options_board
+        n_choices_board = self.n_choices
+        queue = self.queue
+        trail = self.trail
+
         # Fills the box
-        self.board[row][col] = str(choice + 1)
+        self.board[idx] = choice + 1
+
+        # Saves the options in the trail to be able to undo the change
+        trail.append((idx, options_board[idx]))
 
         # Move the box idx to the queue's filled box index
-        n_choices = sum(self.options_board[row][col])
-        self.queue[n_choices].discard((row, col))
-        self.queue[0].add((row, col))
+        n_choices = n_choices_board[idx]
+        queue[n_choices] ^= 1 << idx
+        queue[0] |= 1 << idx
+        nonempty_mask = self.nonempty_mask | 1
+        if not queue[n_choices]:
+            nonempty_mask ^= 1 << n_choices
 
         # Since box is filled, all its options are disabled
-        self.options_board[row][col] = [0] * 9
+        options_board[idx] = 0
+        n_choices_board[idx] = 0
+        dirty_units = self.dirty_units | BOX_UNIT_MASKS[idx]
+
+        # Disables the choice from the row, column and quadrant
+        choice_bit = 1 << choice
+        for peer in PEERS[idx]:
+            options = options_board[peer]
+            if not options & choice_bit:
+                continue
+
+            # Filled boxes have no options, so the box is empty. If you
+            # remove its last choice, the board is unsolvable
+            n_choices = n_choices_board[peer]
+            if n_choices == 1:
+                self.solvable = False
+
+            trail.append((peer, options))
 
-        # Updates the options board of the row and column
-        for n in range(9):
-            self.update_state(row, n, choice)
-            self.update_state(n, col, choice)
+            # Since an option was removed, the number of 
+            # choices for the box decreases by one
+            queue[n_choices] ^= 1 << peer
+            queue[n_choices - 1] |= 1 << peer
+            nonempty_mask |= 1 << (n_choices - 1)
+            if not queue[n_choices]:
+                nonempty_mask ^= 1 << n_choices
 
-        r0 = row//3 * 3
-        c0 = col//3 * 3
+            options_board[peer] = options ^ choice_bit
+            n_choices_board[peer] = n_choices - 1
+            dirty_units |= BOX_UNIT_MASKS[peer]
 
-        # Updates the options board of the box's quadrant
-        for r in range(r0, r0 + 3):
-            for c in range(c0, c0 + 3):
-                if r == row and c == col:
-                    continue
+        self.nonempty_mask = nonempty_mask
+        self.dirty_units = dirty_units
 
-                self.update_state(r, c, choice)
+    def undo(self, checkpoint: int):
+        '''
+        Reverts the board, queue and options board to the state they had
+        when the trail had `checkpoint` entries
+        '''
+        while len(self.trail) > checkpoint:
+            idx, options = self.trail.pop()
+
+            # Only empty boxes are changed, so the box is emptied again
+            self.board[idx] = 0
+
+            # Move the box idx back to the queue index of its old options
+            prev_n_choices = self.n_choices[idx]
+            n_choices = options.bit_count()
+            self.queue[prev_n_choices] ^= 1 << idx
+            self.queue[n_choices] |= 1 << idx
+            self.nonempty_mask |= 1 << n_choices
+            if not self.queue[prev_n_choices]:
+                self.nonempty_mask ^= 1 << prev_n_choices
+
+            self.options_board[idx] = options
+            self.n_choices[idx] = n_choices
+            self.dirty_units |= BOX_UNIT_MASKS[idx]
+
+        # Choices are only made on solvable boards
+        self.solvable = True
     
     def copy(self):
         '''
         Returns a deepcopy of the Sudoku object
-        This is used for the backtracking algorithm
         '''
-        new_queue = [set(q) for q in self.queue]
-        new_board = [row[:] for row in self.board]
-        new_options_board = [
-            [options[:] for options in row]
-            for row in self.options_board
-        ]
+        new_queue = self.queue[:]
+        new_board = bytearray(self.board)
+        new_options_board = self.options_board[:]
 
         return self.__class__(
             board=new_board,
@@ -156,25 +326,12 @@ class Sudoku:
         '''
         Returns a string representation of the board
         '''
-        def format_row(row):
-            return (
-                ' ' + ' '.join(cell for cell in row[:3]) + ' | ' + 
-                ' '.join(cell for cell in row[3:6]) + ' | ' + 
-                ' '.join(cell for cell in row[6:])
-            )
-
-        lines = []
-        for i, row in enumerate(self.board):
-            lines.append(format_row(row))
-            if i in {2, 5}:
-                lines.append('-------+-------+-------')
-
-        return '\n'.join(lines)
+        return BOARD_TEMPLATE.format(*self.board.translate(BOARD_CHARS).decode())
 
     def solve(self, print_time=True) -> bool:
         '''
         Solves the Sudoku board by filling the boxes with the least number of choices,
-        recursively backtracking if the next best box has multiple options.
+        backtracking to the last box with multiple options when a box runs out of choices.
 
         Returns:
         -------
@@ -183,33 +340,113 @@ class Sudoku:
 
         start = time()
 
+        # Stack of (idx, options, checkpoint) for each box with multiple choices,
+        # where options are the choices not yet discarded (the lowest one is
+        # the current choice) and checkpoint is the trail length before it
+        stack = []
+
         while True:
-            n_choices, (row, col) = self.get_next()
+            # If a box ran out of choices, undo the last choice and try the
+            # next one, going back further if the box has no choices left
+            if not self.solvable:
+                while stack:
+                    idx, options, checkpoint = stack.pop()
+
+                    # Discards the choice that didn't lead to a solution and
+                    # tries the next one, skipping the choices that leave a
+                    # box without choices as soon as they are filled
+                    while True:
+                        self.undo(checkpoint)
+                        options &= options - 1
+                        if not options:
+                            break
+
+                        choice = (options & -options).bit_length() - 1
+                        self.fill_box(idx, choice)
+                        if self.solvable:
+                            break
+
+                    if options:
+                        stack.append((idx, options, checkpoint))
+                        break
+                else:
+                    return False
+                continue
+
+            n_choices, idx = self.get_next()
 
-            if (row, col) == (-1, -1):
+            if idx == -1:
                 if print_time:
                     print(f'Solve took: {time() - start:.6f} seconds \n')
                 return True
 
             # If there is only one choice, fill the box
             if n_choices == 1:
-                choice = next(self.get_choice(row, col))
-                self.fill_box(row, col, choice)
+                # The choice is the only bit set in the box options
+                choice = self.options_board[idx].bit_length() - 1
+                self.fill_box(idx, choice)
+                continue
+
+            # If a choice can only go in one box of a row, column or
+            # quadrant, fill that box before branching
+            choice, hidden_idx = self.get_hidden_single()
+            if choice != -1:
+                self.fill_box(hidden_idx, choice)
+                continue
+
+            # If there are multiple choices, try the lowest one first
+            options = self.options_board[idx]
+            stack.append((idx, options, len(self.trail)))
+
+            choice = (options & -options).bit_length() - 1
+            self.fill_box(idx, choice)
+
+    @classmethod
+    def solve_puzzle(cls, puzzle: str) -> str | None:
+        '''
+        Solves a puzzle given as a string with the 81 boxes in row order,
+        using '.' or '0' for empty boxes
+        Raises ValueError if the string has another length or other characters
 
-                if not self.solvable:
-                    return False
+        Returns:
+        -------
+        str: The solved board in the same format, or None if the puzzle is unsolvable.
+        '''
+        if len(puzzle) != 81 or not set(puzzle) <= PUZZLE_CHARS:
+            raise ValueError(
+                "Puzzle must be a string of 81 characters from '.0123456789', "
+                f'got {puzzle!r}'
+            )
 
-            # If there are multiple choices, try each one
-            else:
-                for choice in self.get_choice(row, col):
-                    n_game = self.copy()
-                    n_game.fill_box(row, col, choice)
+        game = cls(bytearray(puzzle.encode().translate(PUZZLE_DIGITS)))
+
+        if not game.solve(print_time=False):
+            return None
+        return game.board.translate(BOARD_CHARS).decode()
+
+    @classmethod
+    def solve_many(
+        cls,
+        puzzles: list[str],
+        processes: int | None = 1
+    ) -> list[str | None]:
+        '''
+        Solves many puzzle strings (see solve_puzzle). Since the puzzles are
+        independent, they are split between `processes` worker processes
+        when it is greater than 1, or between all CPUs if it is None.
+
+        Returns:
+        -------
+        list: The solved boards in the same order, None for unsolvable puzzles.
+        '''
+        puzzles = list(puzzles)
+        if processes is None:
+            processes = os.cpu_count() or 1
 
-                    # If choice leads to a solution, update the current board
-                    if n_game.solve():
-                        self.board = n_game.board
-                        self.options_board = n_game.options_board
-                        self.queue = n_game.queue
-                        return True
+        if processes == 1:
+            return [cls.solve_puzzle(puzzle) for puzzle in puzzles]
 
-                return False
\ No newline at end of file
+        # Sends the puzzles in a few chunks per process to limit the IPC overhead
+        chunksize = max(1, len(puzzles) // (processes * 4))
+        with ProcessPoolExecutor(processes) as executor:
+            return list(executor.map(cls.solve_puzzle, puzzles, chunksize=chunksize))